@@ -11,6 +11,12 @@ import io
 import socket
 import threading
 import random
+import codecs
+import atexit
+from functools import lru_cache
+import queue
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # Inicjalizacja Pygame i konfiguracja okna
 pygame.init()
@@ -19,10 +25,21 @@ screen = pygame.display.set_mode((WIDTH, HEIGHT))
 pygame.display.set_caption("Chess Online + Silnik UCI + Gra na Serwerze")
 clock = pygame.time.Clock()
 FONT = pygame.font.SysFont("Arial", 24)
+# Ruch myszy nie jest nigdzie obsługiwany – blokujemy go raz, aby kolejka
+# zdarzeń opróżniana w każdej klatce zawierała tylko istotne zdarzenia
+pygame.event.set_blocked(pygame.MOUSEMOTION)
+
+@lru_cache(maxsize=256)
+def render(text, color=(0, 0, 0)):
+    """Renderuje napis czcionką FONT; powierzchnie dla powtarzających się napisów są zapamiętywane."""
+    return FONT.render(text, True, color)
 
 # Globalne zmienne i stałe
 piece_images = {}
+piece_images_by_symbol = {}  # te same obrazki pod kluczem chess.Piece.symbol(), np. 'P', 'k'
 move_history = []
+board_surface_cache = {"key": None, "surface": None}
+eval_surface_cache = {"text": None, "surface": None}
 
 # Stałe do rysowania szachownicy
 SQUARE_SIZE = 64
@@ -30,20 +47,60 @@ BOARD_WIDTH = 8 * SQUARE_SIZE
 BOARD_HEIGHT = 8 * SQUARE_SIZE
 DEFAULT_OFFSET_X = (WIDTH - BOARD_WIDTH) // 2
 DEFAULT_OFFSET_Y = (HEIGHT - BOARD_HEIGHT) // 2
+BOARD_RECT = pygame.Rect(DEFAULT_OFFSET_X, DEFAULT_OFFSET_Y, BOARD_WIDTH, BOARD_HEIGHT)
+THERMOMETER_RECT = pygame.Rect(WIDTH - 150, 50, 20, 300)
+# Obszary ekranu gry z silnikiem odświeżane niezależnie od szachownicy
+EVAL_AREA = pygame.Rect(0, 20, WIDTH, FONT.get_height())
+MOVES_AREA = pygame.Rect(0, HEIGHT - 40, WIDTH, 40)
+# Pola w kolejności rysowania (od 8. linii w dół) razem z kolumną i wierszem na ekranie
+DISPLAY_SQUARES = [(chess.square(file, 7 - rank), file, rank) for rank in range(8) for file in range(8)]
+# Prostokąty pól we współrzędnych powierzchni szachownicy, indeksowane numerem pola
+SQUARE_RECTS = [None] * 64
+for _square, _file, _rank in DISPLAY_SQUARES:
+    SQUARE_RECTS[_square] = pygame.Rect(_file * SQUARE_SIZE, _rank * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE)
+# Tło szachownicy (same pola) rysowane raz przy starcie
+BOARD_COLORS = [(240, 217, 181), (181, 136, 99)]
+BOARD_BG_SURFACE = pygame.Surface((BOARD_WIDTH, BOARD_HEIGHT))
+for _square, _file, _rank in DISPLAY_SQUARES:
+    BOARD_BG_SURFACE.fill(BOARD_COLORS[(_rank + _file) % 2], SQUARE_RECTS[_square])
+
+def make_button(text, color, size, label_pos=(10, 5)):
+    """Tworzy powierzchnię przycisku – tło w kolorze color z napisem w położeniu label_pos."""
+    surface = pygame.Surface(size)
+    surface.fill(color)
+    surface.blit(render(text), label_pos)
+    return surface
+
+# Napisy ekranów menu – renderowane raz przy starcie, a nie w każdej klatce.
+# Tabele przycisków (powierzchnia, prostokąt, akcja) są zdefiniowane przy
+# ekranach menu, po funkcjach, które wywołują.
+MAIN_MENU_TITLE = render("Wybierz tryb:", (255, 255, 255))
+CHOOSE_OPPONENT_TITLE = render("Wybierz przeciwnika", (255, 255, 255))
+STATS_TEXT = render("Statystyki - niezaimplementowane", (255, 255, 255))
 
 # Konfiguracja API Lichess
 LICHESS_API_URL = "https://lichess.org/api"
 PUZZLE_API_URL = f"{LICHESS_API_URL}/puzzle/next"
+# Wspólna sesja HTTP utrzymuje połączenie z lichess.org między zapytaniami
+lichess_session = requests.Session()
+# Wątki do zapytań sieciowych, aby nie blokować pętli zdarzeń Pygame
+background_executor = ThreadPoolExecutor(max_workers=2)
 
 # Konfiguracja silnika UCI
 ENGINE_PATH = "./stockfish-ubuntu-x86-64-avx2"  # Upewnij się, że ścieżka jest poprawna
-ANALYSIS_TIME = 0.3
 ENGINE_DEPTH = 15
+EVAL_REFRESH_TIME = 0.3  # co ile sekund pętla gry pobiera nową ocenę z analizy
 
 # Konfiguracja gry online (serwer)
 SERVER_IP = "13.38.13.177"
 SERVER_PORT = 5555
+SERVER_TIMEOUT = 5  # maksymalny czas oczekiwania na odpowiedź serwera (s)
 client_socket = None
+# Komunikaty z serwera rozdzielane przez wątek czytający gniazdo
+pending_requests = deque()        # Future zapytań bieżącego połączenia, w kolejności wysłania
+opponent_moves = queue.Queue()    # komunikaty OPPONENT_MOVE dla pętli gry
+server_outbox = None              # kolejka komunikatów wysyłanych przez server_writer
+server_threads = ()               # (reader, writer) obsługujące bieżące połączenie
 username = ""
 password = ""
 
@@ -60,52 +117,86 @@ def load_piece_images():
         try:
             image = pygame.image.load(path)
             piece_images[p] = pygame.transform.scale(image, (SQUARE_SIZE, SQUARE_SIZE))
+            symbol = p[1].upper() if p[0] == 'w' else p[1]
+            piece_images_by_symbol[symbol] = piece_images[p]
         except Exception as e:
             print(f"Nie można załadować obrazka {path}: {e}")
 
-def draw_board(board, offset_x=DEFAULT_OFFSET_X, offset_y=DEFAULT_OFFSET_Y, square_size=SQUARE_SIZE):
+def board_position_key(board):
+    """Zwraca klucz jednoznacznie opisujący ustawienie figur (na podstawie bitboardów)."""
+    return (board.occupied_co[chess.WHITE], board.pawns, board.knights,
+            board.bishops, board.rooks, board.queens, board.kings)
+
+def draw_board(board, offset_x=DEFAULT_OFFSET_X, offset_y=DEFAULT_OFFSET_Y):
     """Rysuje szachownicę i figury na zadanym obiekcie board."""
-    colors = [(240, 217, 181), (181, 136, 99)]
-    for rank in range(8):
-        for file in range(8):
-            rect = pygame.Rect(offset_x + file * square_size, offset_y + rank * square_size,
-                               square_size, square_size)
-            color = colors[(rank + file) % 2]
-            pygame.draw.rect(screen, color, rect)
-            square = chess.square(file, 7 - rank)
-            piece = board.piece_at(square)
-            if piece:
-                symbol = piece.symbol().lower()
-                color_prefix = 'w' if piece.color == chess.WHITE else 'b'
-                img = piece_images.get(color_prefix + symbol)
-                if img:
-                    img_rect = img.get_rect(center=rect.center)
-                    screen.blit(img, img_rect)
+    # Plansza jest renderowana do osobnej powierzchni tylko po zmianie ustawienia
+    # figur – w pozostałych klatkach wystarcza jedno blit gotowego obrazu
+    key = board_position_key(board)
+    if board_surface_cache["key"] != key:
+        surface = board_surface_cache["surface"]
+        if surface is None:
+            surface = pygame.Surface((BOARD_WIDTH, BOARD_HEIGHT))
+        surface.blit(BOARD_BG_SURFACE, (0, 0))
+        for square, piece in board.piece_map().items():
+            img = piece_images_by_symbol.get(piece.symbol())
+            if img:
+                surface.blit(img, img.get_rect(center=SQUARE_RECTS[square].center))
+        board_surface_cache["key"] = key
+        board_surface_cache["surface"] = surface
+    screen.blit(board_surface_cache["surface"], (offset_x, offset_y))
 
 def draw_thermometer(score):
     """Rysuje termometr odzwierciedlający wartość oceny (score w skali -1 do 1)."""
-    rect = pygame.Rect(WIDTH - 150, 50, 20, 300)
+    score = max(-1.0, min(1.0, score))  # ocena spoza zakresu nie może wyjść poza termometr
     fill_height = int((score + 1) * 150)  # przekształcamy zakres na 0...300 pikseli
-    pygame.draw.rect(screen, (255, 0, 0), rect)
-    pygame.draw.rect(screen, (0, 255, 0), pygame.Rect(WIDTH - 150, 50 + (300 - fill_height), 20, fill_height))
-
-def get_analysis(engine_wrapper, board):
-    """Pobiera analizę z silnika i wyświetla wynik wraz z termometrem."""
-    evaluation_text = engine_wrapper.get_evaluation(board, ANALYSIS_TIME)
-    eval_surface = FONT.render(f"Eval: {evaluation_text}", True, (255, 255, 255))
-    screen.blit(eval_surface, (50, 20))
+    x, y, w, h = THERMOMETER_RECT
+    screen.fill((255, 0, 0), THERMOMETER_RECT)
+    screen.fill((0, 255, 0), (x, y + h - fill_height, w, fill_height))
+
+def get_analysis(engine_wrapper):
+    """
+    Pobiera bieżącą analizę z silnika i wyświetla wynik wraz z termometrem.
+    Zwraca listę obszarów ekranu, które zmieniły się od poprzedniego wywołania.
+    """
+    evaluation_text = engine_wrapper.get_evaluation()
+    dirty_rects = []
+    # Napis renderujemy ponownie tylko wtedy, gdy ocena faktycznie się zmieniła
+    if eval_surface_cache["text"] != evaluation_text:
+        eval_surface_cache["text"] = evaluation_text
+        eval_surface_cache["surface"] = render(f"Eval: {evaluation_text}", (255, 255, 255))
+        dirty_rects = [EVAL_AREA, THERMOMETER_RECT]
+    screen.blit(eval_surface_cache["surface"], (50, 20))
     if evaluation_text.startswith("cp"):
         try:
             cp_val = int(evaluation_text.split(" ")[1])
             draw_thermometer(cp_val / 100)  # przeskalowanie do zakresu -1 do 1
         except Exception as e:
             print("Błąd parsowania oceny:", e)
-    pygame.display.flip()
+    return dirty_rects
+
+def wait_until(done):
+    """Obsługuje zdarzenia okna, dopóki funkcja done() nie zwróci True."""
+    while not done():
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                sys.exit()
+        clock.tick(30)
+
+def wait_for_future(future):
+    """Czeka na wynik zadania uruchomionego w tle, obsługując w tym czasie zdarzenia okna."""
+    wait_until(future.done)
+    return future.result()
+
+def wait_responsive(duration):
+    """Odczekuje duration sekund, obsługując w tym czasie zdarzenia okna (zamiast time.sleep)."""
+    end = time.monotonic() + duration
+    wait_until(lambda: time.monotonic() >= end)
 
 def get_lichess_puzzle():
     """Pobiera zadanie szachowe z API Lichess."""
     try:
-        response = requests.get(PUZZLE_API_URL)
+        response = lichess_session.get(PUZZLE_API_URL, timeout=5)
         if response.status_code == 200:
             puzzle = response.json()
             return puzzle
@@ -123,6 +214,9 @@ class EngineWrapper:
     def __init__(self, engine_path):
         self.engine_path = engine_path
         self.engine = None
+        self.analysis = None
+        self.evaluation = None
+        self.evaluation_time = 0.0
 
     def start_engine(self):
         try:
@@ -132,6 +226,7 @@ class EngineWrapper:
             self.engine = None
 
     def stop_engine(self):
+        self.stop_analysis()
         if self.engine:
             self.engine.quit()
             self.engine = None
@@ -147,12 +242,50 @@ class EngineWrapper:
             print(f"Błąd silnika: {e}")
             return None
 
-    def get_evaluation(self, board: chess.Board, analysis_time=0.5):
+    def start_analysis(self, board: chess.Board):
+        """Uruchamia ciągłą analizę pozycji – silnik liczy w tle, aż do stop_analysis()."""
+        self.stop_analysis()
+        # Poprzednia ocena zostaje na ekranie, dopóki nowa analiza nie poda wyniku;
+        # wyzerowany czas wymusza odczyt przy najbliższym wywołaniu get_evaluation()
+        self.evaluation_time = 0.0
+        if not self.engine:
+            return
+        try:
+            # Do oceny wystarczy wynik – pomijamy parsowanie wariantu (PV)
+            self.analysis = self.engine.analysis(board, info=chess.engine.INFO_SCORE)
+        except Exception as e:
+            print(f"Błąd silnika: {e}")
+            self.analysis = None
+
+    def stop_analysis(self):
+        if self.analysis:
+            self.analysis.stop()
+            self.analysis = None
+
+    def get_evaluation(self):
+        """
+        Zwraca najnowszą ocenę z trwającej analizy bez czekania na silnik.
+        Pętla gry woła tę metodę w każdej klatce, więc analizę odpytujemy
+        co najwyżej co EVAL_REFRESH_TIME, a w pozostałych klatkach zwracamy
+        zapamiętany wynik. Gdy analiza jest wstrzymana (silnik liczy ruch),
+        zwracamy ostatnią znaną ocenę.
+        """
         if not self.engine:
             return "Brak silnika"
+        if not self.analysis:
+            return self.evaluation or "Brak analizy"
+        now = time.monotonic()
+        if now - self.evaluation_time >= EVAL_REFRESH_TIME:
+            self.evaluation = self.read_evaluation()
+            self.evaluation_time = now
+        return self.evaluation
+
+    def read_evaluation(self):
         try:
-            info = self.engine.analyse(board, limit=chess.engine.Limit(time=analysis_time))
-            score = info["score"].relative
+            score = self.analysis.info.get("score")
+            if score is None:
+                return self.evaluation or "Analiza..."
+            score = score.relative
             if score.is_mate():
                 return f"Mate in {score.mate()}"
             else:
@@ -166,79 +299,133 @@ class EngineWrapper:
 
 def play_against_ai():
     """Gra człowieka z silnikiem UCI (Stockfish)."""
+    # Lokalne kopie stałych do przeliczania kliknięcia na pole (LOAD_FAST zamiast LOAD_GLOBAL)
+    ox, oy, sq_size = DEFAULT_OFFSET_X, DEFAULT_OFFSET_Y, SQUARE_SIZE
     engine_wrapper = EngineWrapper(ENGINE_PATH)
     engine_wrapper.start_engine()
 
     board = chess.Board()
     selected_square = None
     move_history.clear()
+    analysed_ply = None
+    move_text = None
+    move_text_len = -1
+    error_text = render("Błędny ruch! Spróbuj ponownie.", (255, 0, 0))
+    error_until = 0
+    # Koniec gry sprawdzamy tylko po wykonaniu ruchu, a nie w każdej klatce
+    game_over = False
+    engine_thread = None
+    engine_result = []
+    engine_ready_at = 0
+    # Na ekran wysyłamy tylko zmienione obszary; całe okno tylko w pierwszej
+    # klatce i po zdarzeniu VIDEOEXPOSE
+    full_redraw = True
+    drawn_ply = -1
+    error_shown = False
+
+    def think(position):
+        engine_result.append(engine_wrapper.get_move(position, ENGINE_DEPTH))
 
     running = True
     while running:
+        # Nowa pozycja na ruchu gracza – silnik analizuje ją w tle
+        if board.turn == chess.WHITE and analysed_ply != len(board.move_stack):
+            engine_wrapper.start_analysis(board)
+            analysed_ply = len(board.move_stack)
+
         screen.fill((30, 30, 30))
         draw_board(board)
-        get_analysis(engine_wrapper, board)
-
-        # Wyświetlenie historii ruchów
-        move_text = FONT.render("Ruchy: " + " ".join([move.uci() for move in move_history]), True, (255, 255, 255))
+        dirty_rects = []
+        if len(board.move_stack) != drawn_ply:
+            drawn_ply = len(board.move_stack)
+            dirty_rects.append(BOARD_RECT)
+        dirty_rects += get_analysis(engine_wrapper)
+
+        # Wyświetlenie historii ruchów (napis tworzony od nowa tylko po nowym ruchu)
+        if len(move_history) != move_text_len:
+            # Historia ruchów jest za każdym razem inna, więc nie trafia do pamięci render()
+            move_text = FONT.render("Ruchy: " + " ".join([move.uci() for move in move_history]), True, (255, 255, 255))
+            move_text_len = len(move_history)
+            dirty_rects.append(MOVES_AREA)
         screen.blit(move_text, (50, HEIGHT - 40))
-        pygame.display.flip()
-
-        if board.is_game_over():
+        # Komunikat o błędnym ruchu jest widoczny przez sekundę, nie wstrzymując pętli
+        error_visible = pygame.time.get_ticks() < error_until
+        if error_visible:
+            dirty_rects.append(screen.blit(error_text, (WIDTH // 2 - 100, HEIGHT - 50)))
+        elif error_shown:
+            dirty_rects.append(error_text.get_rect(topleft=(WIDTH // 2 - 100, HEIGHT - 50)))
+        error_shown = error_visible
+
+        if full_redraw:
+            pygame.display.flip()
+            full_redraw = False
+        elif dirty_rects:
+            pygame.display.update(dirty_rects)
+
+        if game_over:
             result = board.result()
             print("Gra zakończona:", result)
-            time.sleep(3)
+            # Trwająca analiza trzymałaby proces silnika (i zamknięcie programu)
+            # do końca pauzy, więc zatrzymujemy silnik od razu
+            engine_wrapper.stop_engine()
+            wait_responsive(3)
             break
 
-        if board.turn == chess.WHITE:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    x, y = event.pos
-                    file = (x - DEFAULT_OFFSET_X) // SQUARE_SIZE
-                    rank = 7 - ((y - DEFAULT_OFFSET_Y) // SQUARE_SIZE)
-                    if 0 <= file < 8 and 0 <= rank < 8:
-                        square = chess.square(file, rank)
-                        if selected_square is None:
-                            if board.piece_at(square) and board.piece_at(square).color == chess.WHITE:
-                                selected_square = square
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                engine_wrapper.stop_engine()
+                pygame.quit()
+                sys.exit()
+            elif event.type == pygame.VIDEOEXPOSE:
+                full_redraw = True
+            elif event.type == pygame.MOUSEBUTTONDOWN and board.turn == chess.WHITE:
+                x, y = event.pos
+                file = (x - ox) // sq_size
+                rank = 7 - ((y - oy) // sq_size)
+                if 0 <= file < 8 and 0 <= rank < 8:
+                    square = rank * 8 + file
+                    if selected_square is None:
+                        piece = board.piece_at(square)
+                        if piece and piece.color == chess.WHITE:
+                            selected_square = square
+                    else:
+                        move = chess.Move(selected_square, square)
+                        if board.is_legal(move):
+                            board.push(move)
+                            move_history.append(move)
+                            game_over = board.is_game_over()
+                            selected_square = None
                         else:
-                            move = chess.Move(selected_square, square)
-                            if move in board.legal_moves:
-                                board.push(move)
-                                move_history.append(move)
-                                selected_square = None
-                            else:
-                                error_text = FONT.render("Błędny ruch! Spróbuj ponownie.", True, (255, 0, 0))
-                                screen.blit(error_text, (WIDTH // 2 - 100, HEIGHT - 50))
-                                pygame.display.flip()
-                                time.sleep(1)
-                                selected_square = None
-        else:
-            time.sleep(0.5)
-            engine_move = engine_wrapper.get_move(board, ENGINE_DEPTH)
-            if engine_move and engine_move in board.legal_moves:
+                            error_until = pygame.time.get_ticks() + 1000
+                            selected_square = None
+
+        # Silnik liczy ruch w osobnym wątku na kopii pozycji, a pętla w tym czasie
+        # dalej rysuje ekran i obsługuje zdarzenia
+        if board.turn == chess.BLACK and not game_over:
+            if engine_thread is None:
+                engine_wrapper.stop_analysis()
+                engine_result.clear()
+                engine_ready_at = pygame.time.get_ticks() + 500  # ruch silnika najwcześniej po 0,5 s
+                engine_thread = threading.Thread(target=think, args=(board.copy(),), daemon=True)
+                engine_thread.start()
+            elif not engine_thread.is_alive() and pygame.time.get_ticks() >= engine_ready_at:
+                engine_thread = None
+                engine_move = engine_result[0] if engine_result else None
+                if not engine_move or not board.is_legal(engine_move):
+                    engine_move = random.choice(list(board.legal_moves))
                 board.push(engine_move)
                 move_history.append(engine_move)
-            else:
-                mv = random.choice(list(board.legal_moves))
-                board.push(mv)
-                move_history.append(mv)
+                game_over = board.is_game_over()
 
         clock.tick(30)
 
     engine_wrapper.stop_engine()
 
-def pgn_to_fen(pgn):
-    """Konwertuje zapis PGN do pozycji FEN."""
+def pgn_to_board(pgn):
+    """Odtwarza z zapisu PGN końcową pozycję partii."""
     pgn_io = io.StringIO(pgn)
     game = chess.pgn.read_game(pgn_io)
-    board = game.board()
-    for move in game.mainline_moves():
-        board.push(move)
-    return board.fen()
+    return game.end().board()
 
 def draw_puzzle(puzzle):
     """Wyświetla zadanie szachowe z Lichess oraz sprawdza ruchy rozwiązania."""
@@ -246,14 +433,15 @@ def draw_puzzle(puzzle):
         print("Brak zadania do wyświetlenia")
         return
 
+    ox, oy, sq_size = DEFAULT_OFFSET_X, DEFAULT_OFFSET_Y, SQUARE_SIZE
     pgn = puzzle['game']['pgn']
-    fen = pgn_to_fen(pgn)
-    board = chess.Board(fen)
+    board = pgn_to_board(pgn)
     screen.fill((30, 30, 30))
     draw_board(board)
     pygame.display.flip()
 
-    solution_moves = puzzle['puzzle']['solution']
+    # Rozwiązanie parsujemy raz, zamiast przy każdym kliknięciu
+    solution_moves = [chess.Move.from_uci(m) for m in puzzle['puzzle']['solution']]
     solution_index = 0
 
     selected_square = None
@@ -267,49 +455,49 @@ def draw_puzzle(puzzle):
 
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 x, y = event.pos
-                file = (x - DEFAULT_OFFSET_X) // SQUARE_SIZE
-                rank = 7 - ((y - DEFAULT_OFFSET_Y) // SQUARE_SIZE)
+                file = (x - ox) // sq_size
+                rank = 7 - ((y - oy) // sq_size)
                 if 0 <= file < 8 and 0 <= rank < 8:
-                    square = chess.square(file, rank)
+                    square = rank * 8 + file
                     if selected_square is None:
                         piece = board.piece_at(square)
                         if piece and piece.color == board.turn:
                             selected_square = square
                     else:
                         move = chess.Move(selected_square, square)
-                        if move in board.legal_moves:
+                        correct_move = None
+                        if solution_index < len(solution_moves):
+                            correct_move = solution_moves[solution_index]
+                        # Ruch zgodny z rozwiązaniem jest legalny z definicji – legalność
+                        # sprawdzamy tylko dla pozostałych ruchów
+                        if move == correct_move:
+                            board.push(move)
+                            draw_board(board)
+                            pygame.display.update(BOARD_RECT)
+                            solution_index += 1
+                            selected_square = None
+                            pygame.time.wait(500)
                             if solution_index < len(solution_moves):
-                                correct_move_str = solution_moves[solution_index]
-                                correct_move = chess.Move.from_uci(correct_move_str)
-                                if move == correct_move:
-                                    board.push(move)
-                                    draw_board(board)
-                                    pygame.display.flip()
+                                enemy_move = solution_moves[solution_index]
+                                if board.is_legal(enemy_move):
+                                    board.push(enemy_move)
                                     solution_index += 1
-                                    selected_square = None
-                                    pygame.time.wait(500)
-                                    if solution_index < len(solution_moves):
-                                        enemy_move_str = solution_moves[solution_index]
-                                        enemy_move = chess.Move.from_uci(enemy_move_str)
-                                        if enemy_move in board.legal_moves:
-                                            board.push(enemy_move)
-                                            solution_index += 1
-                                            draw_board(board)
-                                            pygame.display.flip()
-                                        else:
-                                            print("Błąd: nielegalny ruch przeciwnika", enemy_move_str)
-                                            running_puzzle = False
-                                    else:
-                                        print("✅ Zadanie ukończone! Gratulacje!")
-                                        running_puzzle = False
+                                    draw_board(board)
+                                    pygame.display.update(BOARD_RECT)
                                 else:
-                                    print(f"❌ Niepoprawny ruch! Oczekiwany ruch: {correct_move_str}")
-                                    selected_square = None
+                                    print("Błąd: nielegalny ruch przeciwnika", enemy_move.uci())
+                                    running_puzzle = False
                             else:
-                                print("Zadanie już zakończone.")
+                                print("✅ Zadanie ukończone! Gratulacje!")
                                 running_puzzle = False
-                        else:
+                        elif not board.is_legal(move):
                             selected_square = None
+                        elif correct_move is not None:
+                            print(f"❌ Niepoprawny ruch! Oczekiwany ruch: {correct_move.uci()}")
+                            selected_square = None
+                        else:
+                            print("Zadanie już zakończone.")
+                            running_puzzle = False
 
         clock.tick(30)
 
@@ -317,15 +505,90 @@ def draw_puzzle(puzzle):
 # Funkcje trybu gry online – komunikacja z serwerem, lobby, rozgrywka
 # ============================================================================
 
-def send_to_server(data):
-    """Wysyła dane do serwera i odbiera odpowiedź."""
-    global client_socket
+def server_reader(sock, pending):
+    """
+    Jedyny wątek czytający z gniazda serwera. Ruchy przeciwnika trafiają do
+    kolejki opponent_moves, a pozostałe komunikaty są odpowiedziami – serwer
+    odpowiada w kolejności zapytań, więc rozwiązują najstarszy Future
+    z kolejki pending należącej do tego połączenia.
+    """
+    # Jeden bufor na całe połączenie – recv_into nie tworzy nowego obiektu bytes
+    # dla każdego komunikatu. Dekoder przyrostowy zatrzymuje niepełny znak
+    # wielobajtowy do następnego odczytu zamiast zgłaszać błąd.
+    buffer = bytearray(4096)
+    view = memoryview(buffer)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        try:
+            size = sock.recv_into(view)
+            if not size:
+                print("Serwer zamknął połączenie")
+                break
+            message = decoder.decode(view[:size])
+            if not message:
+                continue
+            if message.startswith("OPPONENT_MOVE"):
+                opponent_moves.put(message)
+            elif pending:
+                pending.popleft().set_result(message)
+            else:
+                print("Nieoczekiwany komunikat serwera:", message)
+        except Exception as e:
+            print("Błąd odbierania danych:", e)
+            break
+    # Po zerwaniu połączenia nikt nie powinien dalej czekać na odpowiedź
+    while pending:
+        pending.popleft().set_result("ERROR|Rozłączono")
+
+def server_writer(sock, outbox):
+    """
+    Wysyła komunikaty z kolejki outbox, dzięki czemu pętla gry nie czeka na sieć.
+    Kończy pracę po otrzymaniu None lub po błędzie gniazda.
+    """
+    while True:
+        data = outbox.get()
+        if data is None:
+            break
+        try:
+            sock.sendall(data.encode())
+        except Exception as e:
+            print("Błąd wysyłania danych:", e)
+            break
+
+def post_to_server(data):
+    """Kolejkuje komunikat do serwera bez czekania na odpowiedź."""
+    server_outbox.put(data)
+
+def request_from_server(data):
+    """
+    Wysyła zapytanie do serwera bez czekania. Zwraca Future, który wątek
+    server_reader uzupełni odpowiedzią serwera.
+    """
+    future = Future()
+    pending = pending_requests
     try:
-        client_socket.send(data.encode())
-        return client_socket.recv(2048).decode()
+        pending.append(future)
+        post_to_server(data)
     except Exception as e:
+        pending.remove(future)
         print("Błąd komunikacji z serwerem:", e)
-        return "ERROR|Błąd komunikacji"
+        future.set_result("ERROR|Błąd komunikacji")
+    return future
+
+def send_to_server(data):
+    """
+    Wysyła dane do serwera i czeka na odpowiedź (najwyżej SERVER_TIMEOUT),
+    obsługując w tym czasie zdarzenia okna.
+    """
+    future = request_from_server(data)
+    end = time.monotonic() + SERVER_TIMEOUT
+    wait_until(lambda: future.done() or time.monotonic() >= end)
+    if not future.done():
+        # Zapytanie zostaje w pending_requests, aby spóźniona odpowiedź nie
+        # została przypisana do następnego zapytania
+        print("Brak odpowiedzi serwera na:", data)
+        return "ERROR|Brak odpowiedzi"
+    return future.result()
 
 def login_screen():
     """Logowanie do serwera – wykorzystujemy przykładowe dane."""
@@ -337,38 +600,53 @@ def login_screen():
 
 def launch_online_game(color, opponent):
     """
-    Rozpoczyna grę online. Tworzy wątek odbierający ruchy przeciwnika
-    oraz główną pętlę gry.
+    Rozpoczyna grę online. Ruchy przeciwnika odbiera wątek server_reader,
+    a wykonuje je główna pętla gry – plansza zmieniana jest tylko w tym wątku.
     """
+    ox, oy, sq_size = DEFAULT_OFFSET_X, DEFAULT_OFFSET_Y, SQUARE_SIZE
     board = chess.Board()
     is_white = color.lower() == "white"
     selected_square = None
     running = True
 
-    def receive_thread():
-        nonlocal board
-        while True:
-            try:
-                data = client_socket.recv(1024).decode()
-                if data.startswith("OPPONENT_MOVE"):
-                    move = data.split("|")[1]
-                    board.push_uci(move)
-            except Exception as e:
-                print("Błąd odbierania danych:", e)
-                break
-
-    threading.Thread(target=receive_thread, daemon=True).start()
-
+    # Pomijamy ruchy, które mogły zostać w kolejce po poprzedniej partii
+    while not opponent_moves.empty():
+        opponent_moves.get_nowait()
+
+    # Ekran przerysowujemy tylko po zmianie pozycji lub gdy okno wymaga odświeżenia
+    needs_redraw = True
+    drawn_ply = -1
+    # Legalne ruchy generujemy raz na pozycję, a nie przy każdym kliknięciu
+    legal_cache = frozenset()
+    legal_cache_ply = -1
+    # Koniec gry sprawdzamy tylko po wykonaniu ruchu, a nie w każdej klatce
+    game_over = False
     while running:
-        screen.fill((30, 30, 30))
-        draw_board(board)
-        pygame.display.flip()
-
-        if board.is_game_over():
+        while not opponent_moves.empty():
+            message = opponent_moves.get_nowait()
+            try:
+                board.push_uci(message.split("|")[1])
+                game_over = board.is_game_over()
+            except (IndexError, ValueError) as e:
+                print("Błędny ruch przeciwnika:", e)
+
+        if needs_redraw:
+            needs_redraw = False
+            drawn_ply = len(board.move_stack)
+            screen.fill((30, 30, 30))
+            draw_board(board)
+            pygame.display.flip()
+        elif len(board.move_stack) != drawn_ply:
+            # Po ruchu zmienia się tylko szachownica – odświeżamy wyłącznie jej obszar
+            drawn_ply = len(board.move_stack)
+            draw_board(board)
+            pygame.display.update(BOARD_RECT)
+
+        if game_over:
             result = board.result()
-            send_to_server(f"GAME_OVER|{username}|{opponent}|{result}")
+            request_from_server(f"GAME_OVER|{username}|{opponent}|{result}")
             print("Gra zakończona:", result)
-            time.sleep(3)
+            wait_responsive(3)
             break
 
         for event in pygame.event.get():
@@ -376,22 +654,30 @@ def launch_online_game(color, opponent):
                 running = False
                 break
 
+            elif event.type == pygame.VIDEOEXPOSE:
+                needs_redraw = True
+
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 # Zezwalamy na ruch, jeśli to nasza tura
                 if (board.turn == chess.WHITE and is_white) or (board.turn == chess.BLACK and not is_white):
                     x, y = event.pos
-                    file = (x - DEFAULT_OFFSET_X) // SQUARE_SIZE
-                    rank = 7 - ((y - DEFAULT_OFFSET_Y) // SQUARE_SIZE)
+                    file = (x - ox) // sq_size
+                    rank = 7 - ((y - oy) // sq_size)
                     if 0 <= file < 8 and 0 <= rank < 8:
-                        square = chess.square(file, rank)
+                        square = rank * 8 + file
                         if selected_square is None:
-                            if board.piece_at(square) and board.piece_at(square).color == board.turn:
+                            piece = board.piece_at(square)
+                            if piece and piece.color == board.turn:
                                 selected_square = square
                         else:
                             move = chess.Move(selected_square, square)
-                            if move in board.legal_moves:
+                            if legal_cache_ply != len(board.move_stack):
+                                legal_cache = frozenset(board.legal_moves)
+                                legal_cache_ply = len(board.move_stack)
+                            if move in legal_cache:
                                 board.push(move)
-                                send_to_server(f"MOVE|{opponent}|{move.uci()}")
+                                game_over = board.is_game_over()
+                                request_from_server(f"MOVE|{opponent}|{move.uci()}")
                             selected_square = None
         clock.tick(30)
 
@@ -401,155 +687,240 @@ def wait_for_match():
     Dla celów demonstracyjnych symulujemy oczekiwanie.
     """
     print("Oczekiwanie na przeciwnika...")
-    time.sleep(2)  # symulacja oczekiwania
+    wait_responsive(2)  # symulacja oczekiwania
     # Symulujemy: otrzymujemy kolor i nazwę przeciwnika
     return "white", "Przeciwnik1"
 
+def start_online_match():
+    """Zgłasza serwerowi chęć gry, czeka na przeciwnika i rozpoczyna partię online."""
+    request_from_server("START_MATCH")
+    color, opponent = wait_for_match()
+    launch_online_game(color, opponent)
+
+# Przyciski wyboru przeciwnika: (powierzchnia, prostokąt, akcja); None – powrót bez akcji
+CHOOSE_OPPONENT_BUTTONS = [
+    (make_button("Losowy gracz online", (100, 100, 250), (300, 40), (20, 5)), pygame.Rect(250, 120, 300, 40),
+     start_online_match),
+    (make_button("Zagraj z botem (AI)", (100, 200, 100), (300, 40), (20, 5)), pygame.Rect(250, 180, 300, 40),
+     play_against_ai),
+    (make_button("Anuluj", (200, 100, 100), (300, 40), (110, 5)), pygame.Rect(250, 240, 300, 40), None),
+]
+
+def draw_choose_opponent():
+    """Rysuje menu wyboru przeciwnika."""
+    screen.fill((20, 20, 20))
+    title = CHOOSE_OPPONENT_TITLE
+    screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 50))
+    for button, rect, _ in CHOOSE_OPPONENT_BUTTONS:
+        screen.blit(button, rect)
+    pygame.display.flip()
+
 def choose_opponent():
     """Menu wyboru przeciwnika online lub gry z botem."""
+    # Ekran jest statyczny – rysujemy go tylko wtedy, gdy coś go zasłoniło
+    needs_redraw = True
     while True:
-        screen.fill((20, 20, 20))
-        title = FONT.render("Wybierz przeciwnika", True, (255, 255, 255))
-        screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 50))
-        pygame.draw.rect(screen, (100, 100, 250), (250, 120, 300, 40))
-        screen.blit(FONT.render("Losowy gracz online", True, (0, 0, 0)), (270, 125))
-        pygame.draw.rect(screen, (100, 200, 100), (250, 180, 300, 40))
-        screen.blit(FONT.render("Zagraj z botem (AI)", True, (0, 0, 0)), (270, 185))
-        pygame.draw.rect(screen, (200, 100, 100), (250, 240, 300, 40))
-        screen.blit(FONT.render("Anuluj", True, (0, 0, 0)), (360, 245))
-        pygame.display.flip()
+        if needs_redraw:
+            draw_choose_opponent()
+            needs_redraw = False
 
-        for event in pygame.event.get():
+        # Bez animacji nie ma po co budzić się co klatkę – czekamy na zdarzenie
+        events = [pygame.event.wait()] + pygame.event.get()
+        for event in events:
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
+            elif event.type == pygame.VIDEOEXPOSE:
+                needs_redraw = True
             elif event.type == pygame.MOUSEBUTTONDOWN:
-                x, y = event.pos
-                if 250 <= x <= 550:
-                    if 120 <= y <= 160:
-                        send_to_server("START_MATCH")
-                        color, opponent = wait_for_match()
-                        launch_online_game(color, opponent)
-                        return
-                    elif 180 <= y <= 220:
-                        play_against_ai()  # Gra offline z botem
-                        return
-                    elif 240 <= y <= 280:
+                for _, rect, action in CHOOSE_OPPONENT_BUTTONS:
+                    if rect.collidepoint(event.pos):
+                        if action:
+                            action()
                         return
-        clock.tick(30)
 
 def stats_screen():
     """Tymczasowy ekran statystyk."""
     screen.fill((20, 20, 20))
-    stat_text = FONT.render("Statystyki - niezaimplementowane", True, (255, 255, 255))
+    stat_text = STATS_TEXT
     screen.blit(stat_text, (WIDTH//2 - stat_text.get_width()//2, HEIGHT//2))
     pygame.display.flip()
-    time.sleep(2)
-
-def draw_lobby():
+    wait_responsive(2)
+
+# Przyciski lobby: (powierzchnia, prostokąt, akcja); None – powrót do menu głównego
+LOBBY_BUTTONS = [
+    (make_button("Szybki mecz online", (80, 80, 200), (200, 40), (5, 10)), pygame.Rect(50, 100, 200, 40),
+     choose_opponent),
+    (make_button("Statystyki", (80, 200, 100), (200, 40), (40, 10)), pygame.Rect(50, 160, 200, 40),
+     stats_screen),
+    (make_button("Wyloguj", (200, 80, 80), (200, 40), (65, 10)), pygame.Rect(50, 220, 200, 40), None),
+]
+
+def draw_lobby(welcome_text):
     """Rysuje lobby gracza online."""
     screen.fill((20, 20, 20))
-    welcome_text = FONT.render(f"Witaj, {username}!", True, (255, 255, 255))
     screen.blit(welcome_text, (50, 30))
-    pygame.draw.rect(screen, (80, 80, 200), (50, 100, 200, 40))
-    screen.blit(FONT.render("Szybki mecz online", True, (0, 0, 0)), (55, 110))
-    pygame.draw.rect(screen, (80, 200, 100), (50, 160, 200, 40))
-    screen.blit(FONT.render("Statystyki", True, (0, 0, 0)), (90, 170))
-    pygame.draw.rect(screen, (200, 80, 80), (50, 220, 200, 40))
-    screen.blit(FONT.render("Wyloguj", True, (0, 0, 0)), (115, 230))
+    for button, rect, _ in LOBBY_BUTTONS:
+        screen.blit(button, rect)
     pygame.display.flip()
 
+
 def lobby_screen():
     """Menu lobby – wybór opcji w trybie online."""
+    # Powitanie zależy od zalogowanego gracza, więc renderujemy je przy wejściu do lobby
+    welcome_text = render(f"Witaj, {username}!", (255, 255, 255))
+    # Lobby rysujemy przy wejściu i po powrocie z innego ekranu, a nie w każdej klatce
+    needs_redraw = True
     while True:
-        draw_lobby()
-        for event in pygame.event.get():
+        if needs_redraw:
+            draw_lobby(welcome_text)
+            needs_redraw = False
+
+        # Bez animacji nie ma po co budzić się co klatkę – czekamy na zdarzenie
+        events = [pygame.event.wait()] + pygame.event.get()
+        for event in events:
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
+            elif event.type == pygame.VIDEOEXPOSE:
+                needs_redraw = True
             elif event.type == pygame.MOUSEBUTTONDOWN:
-                x, y = event.pos
-                if 50 <= x <= 250:
-                    if 100 <= y <= 140:
-                        choose_opponent()
-                    elif 160 <= y <= 200:
-                        stats_screen()
-                    elif 220 <= y <= 260:
-                        return  # Wylogowanie, powrót do menu głównego
-        clock.tick(30)
-
-def online_game_mode():
-    """Łączy się z serwerem, loguje użytkownika i przechodzi do lobby."""
-    global client_socket
+                needs_redraw = True
+                for _, rect, action in LOBBY_BUTTONS:
+                    if rect.collidepoint(event.pos):
+                        if action is None:
+                            return
+                        action()
+                        break
+
+def get_connection():
+    """
+    Zwraca połączone i zalogowane gniazdo serwera. Połączenie jest tworzone
+    przy pierwszym wejściu do trybu online i używane ponownie przy kolejnych –
+    nowe nawiązujemy tylko wtedy, gdy poprzednie zostało zerwane.
+    Zwraca None, jeśli nie udało się połączyć.
+    """
+    global client_socket, server_outbox, server_threads, pending_requests
+    if client_socket is not None and all(thread.is_alive() for thread in server_threads):
+        return client_socket
+    close_connection()
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((SERVER_IP, SERVER_PORT))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((SERVER_IP, SERVER_PORT))
+        # Krótkie komunikaty (ruchy) wysyłamy od razu, bez czekania algorytmu Nagle'a
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
     except Exception as e:
         print("Błąd połączenia z serwerem:", e)
-        time.sleep(2)
+        return None
+    client_socket = sock
+    # Każde połączenie ma własną kolejkę zapytań – kończący się wątek starego
+    # połączenia nie może rozwiązać zapytań wysłanych już nowym
+    pending_requests = deque()
+    server_outbox = queue.Queue()
+    reader = threading.Thread(target=server_reader, args=(sock, pending_requests), daemon=True)
+    writer = threading.Thread(target=server_writer, args=(sock, server_outbox), daemon=True)
+    reader.start()
+    writer.start()
+    server_threads = (reader, writer)
+    login_screen()
+    return client_socket
+
+def close_connection():
+    """Zamyka połączenie z serwerem (jeśli jest), wysyłając najpierw zaległe komunikaty."""
+    global client_socket, server_threads
+    if client_socket is None:
         return
+    # Przed zamknięciem gniazda wysyłamy komunikaty, które zostały w kolejce
+    server_outbox.put(None)
+    if server_threads:
+        server_threads[1].join(SERVER_TIMEOUT)
+    # Samo close() nie budzi wątku czekającego w recv_into – shutdown kończy
+    # odczyt i wysyła serwerowi FIN
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # połączenie mogło już zostać zerwane
+    client_socket.close()
+    if server_threads:
+        server_threads[0].join(SERVER_TIMEOUT)
+    client_socket = None
+    server_threads = ()
 
-    login_screen()
+atexit.register(close_connection)
+
+def online_game_mode():
+    """Przechodzi do lobby, korzystając z połączenia z serwerem (nawiązuje je w razie potrzeby)."""
+    if get_connection() is None:
+        wait_responsive(2)
+        return
     lobby_screen()
-    client_socket.close()
 
 # ============================================================================
 # Menu główne
 # ============================================================================
 
+def analysis_mode():
+    """Tryb analizy partii – na razie tylko komunikat."""
+    print("Analiza partii - funkcja niezaimplementowana.")
+    wait_responsive(2)
+
+def puzzle_mode():
+    """Pobiera zadanie z Lichess w tle i wyświetla je."""
+    puzzle = wait_for_future(background_executor.submit(get_lichess_puzzle))
+    draw_puzzle(puzzle)
+
+def quit_game():
+    """Zamyka okno i kończy program."""
+    pygame.quit()
+    sys.exit()
+
+# Przyciski menu głównego: (powierzchnia, prostokąt, akcja) – ta sama tabela
+# służy do rysowania i do sprawdzania kliknięć, więc nie mogą się rozjechać
+MAIN_BUTTONS = [
+    (make_button(text, color, (300, 40)), pygame.Rect(250, y, 300, 40), action)
+    for text, y, color, action in [
+        ("Gra z silnikiem", 100, (100, 100, 250), play_against_ai),
+        ("Analiza partii", 160, (100, 200, 100), analysis_mode),
+        ("Zadania z Lichess", 220, (200, 100, 100), puzzle_mode),
+        ("Gra na serwerze", 280, (150, 150, 50), online_game_mode),
+        ("Zakończ", 340, (200, 80, 80), quit_game),
+    ]
+]
+
+def draw_main_menu():
+    """Rysuje menu główne."""
+    screen.fill((20, 20, 20))
+    title = MAIN_MENU_TITLE
+    screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 30))
+
+    for button, rect, _ in MAIN_BUTTONS:
+        screen.blit(button, rect)
+
+    pygame.display.flip()
+
 def main_menu():
+    # Menu rysujemy przy starcie i po powrocie z innego ekranu, a nie w każdej klatce
+    needs_redraw = True
     while True:
-        screen.fill((20, 20, 20))
-        title = FONT.render("Wybierz tryb:", True, (255, 255, 255))
-        screen.blit(title, (WIDTH // 2 - title.get_width() // 2, 30))
-        
-        # Definicja przycisków i ich położenie
-        buttons = [
-            ("Gra z silnikiem", 100),
-            ("Analiza partii", 160),
-            ("Zadania z Lichess", 220),
-            ("Gra na serwerze", 280),
-            ("Zakończ", 340)
-        ]
-        for text, y in buttons:
-            rect = pygame.Rect(250, y, 300, 40)
-            if text == "Gra z silnikiem":
-                color = (100, 100, 250)
-            elif text == "Analiza partii":
-                color = (100, 200, 100)
-            elif text == "Zadania z Lichess":
-                color = (200, 100, 100)
-            elif text == "Gra na serwerze":
-                color = (150, 150, 50)
-            elif text == "Zakończ":
-                color = (200, 80, 80)
-            pygame.draw.rect(screen, color, rect)
-            label = FONT.render(text, True, (0, 0, 0))
-            screen.blit(label, (rect.x + 10, rect.y + 5))
-        
-        pygame.display.flip()
-        
-        for event in pygame.event.get():
+        if needs_redraw:
+            draw_main_menu()
+            needs_redraw = False
+
+        # Bez animacji nie ma po co budzić się co klatkę – czekamy na zdarzenie
+        events = [pygame.event.wait()] + pygame.event.get()
+        for event in events:
             if event.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
+            elif event.type == pygame.VIDEOEXPOSE:
+                needs_redraw = True
             elif event.type == pygame.MOUSEBUTTONDOWN:
-                x, y = event.pos
-                if 250 <= x <= 550:
-                    if 100 <= y <= 140:
-                        play_against_ai()         # Gra z silnikiem
-                    elif 160 <= y <= 200:
-                        print("Analiza partii - funkcja niezaimplementowana.")
-                        time.sleep(2)
-                    elif 220 <= y <= 260:
-                        puzzle = get_lichess_puzzle()
-                        draw_puzzle(puzzle)         # Zadania z Lichess
-                    elif 280 <= y <= 320:
-                        online_game_mode()          # Gra na serwerze
-                    elif 340 <= y <= 380:
-                        pygame.quit()
-                        sys.exit()
-        clock.tick(30)
+                needs_redraw = True
+                for _, rect, action in MAIN_BUTTONS:
+                    if rect.collidepoint(event.pos):
+                        action()
+                        break
 
 def main():
     load_piece_images()